@@ -1,7 +1,14 @@
 import csv
-import itertools
+import multiprocessing
 import sys
 
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
 PROBS = {
 
     # Unconditional probabilities for having gene
@@ -36,230 +43,608 @@ PROBS = {
     "mutation": 0.01
 }
 
+# Lookups of PROBS hoisted out of the inner loops
+_MUT = PROBS["mutation"]
+_NOMUT = 1 - _MUT
 
-def main():
+# Probability that a child inherits the gene from a parent, indexed by
+# [child_has_gene, parent_genes]; a parent with one copy passes it (or passes
+# the other copy and it mutates) half the time
+_PASS = ((_NOMUT, 0.5, _MUT), (_MUT, 0.5, _NOMUT))
 
-    # Check for proper usage
-    if len(sys.argv) != 2:
-        sys.exit("Usage: python heredity.py data.csv")
-    people = load_data(sys.argv[1])
-
-    # Keep track of gene and trait probabilities for each person
-    probabilities = {
-        person: {
-            "gene": {
-                2: 0,
-                1: 0,
-                0: 0
-            },
-            "trait": {
-                True: 0,
-                False: 0
-            }
-        }
-        for person in people
-    }
-
-    # Loop over all sets of people who might have the trait
-    names = set(people)
-    for have_trait in powerset(names):
-
-        # Check if current set of people violates known information
-        fails_evidence = any(
-            (people[person]["trait"] is not None and
-             people[person]["trait"] != (person in have_trait))
-            for person in names
-        )
-        if fails_evidence:
-            continue
+# Probability of having 0, 1 or 2 copies of the gene
+_GENE_TBL = np.array([PROBS["gene"][0], PROBS["gene"][1], PROBS["gene"][2]])
 
-        # Loop over all sets of people who might have the gene
-        for one_gene in powerset(names):
-            for two_genes in powerset(names - one_gene):
+# Probability of the trait, indexed by [genes, has_trait]
+_TRAIT_TBL = np.array([
+    [PROBS["trait"][0][False], PROBS["trait"][0][True]],
+    [PROBS["trait"][1][False], PROBS["trait"][1][True]],
+    [PROBS["trait"][2][False], PROBS["trait"][2][True]]
+])
 
-                # Update probabilities with new joint probability
-                p = joint_probability(people, one_gene, two_genes, have_trait)
-                update(probabilities, one_gene, two_genes, have_trait, p)
+# Number of joint probabilities enumerate_assignments computes at once
+BLOCK_SIZE = 1 << 20
 
-    # Ensure probabilities sum to 1
-    normalize(probabilities)
+# Largest share of the total probability that enumeration may skip, once
+# when skipping whole blocks and once within each block, far below the
+# printed precision even after normalizing
+TOLERANCE = 1e-9
 
-    # Print results
-    for person in people:
-        print(f"{person}:")
-        for field in probabilities[person]:
-            print(f"  {field.capitalize()}:")
-            for value in probabilities[person][field]:
-                p = probabilities[person][field][value]
-                print(f"    {value}: {p:.4f}")
+
+def main():
+
+    # Check for proper usage
+    if len(sys.argv) < 2 or sys.argv[2:] not in ([], ["--enumerate"]):
+        sys.exit("Usage: python heredity.py data.csv [--enumerate]")
+    names, mothers, fathers, trait_obs = load_data(sys.argv[1])
+
+    # Keep track of gene and trait probabilities for each person, one row
+    # per person with columns for 0, 1 and 2 copies of the gene, then for
+    # not having and having the trait
+    acc = np.zeros((len(names), 5))
+
+    if sys.argv[2:] == ["--enumerate"]:
+        # Sum the joint probability of every assignment explicitly
+        enumerate_assignments(mothers, fathers, trait_obs, acc)
+    else:
+        # Marginalize each person directly
+        eliminate_variables(mothers, fathers, trait_obs, acc)
+
+    # Ensure probabilities sum to 1
+    normalize(acc)
+
+    # Print results, written out at once
+    lines = []
+    for i, person in enumerate(names):
+        lines += [
+            f"{person}:",
+            "  Gene:",
+            f"    2: {acc[i, 2]:.4f}",
+            f"    1: {acc[i, 1]:.4f}",
+            f"    0: {acc[i, 0]:.4f}",
+            "  Trait:",
+            f"    True: {acc[i, 4]:.4f}",
+            f"    False: {acc[i, 3]:.4f}"
+        ]
+    sys.stdout.write("".join(line + "\n" for line in lines))
 
 
 def load_data(filename):
     """
-    Load gene and trait data from a file into a dictionary.
+    Load gene and trait data from a file into arrays indexed by person.
     File assumed to be a CSV containing fields name, mother, father, trait.
     mother, father must both be blank, or both be valid names in the CSV.
     trait should be 0 or 1 if trait is known, blank otherwise.
+
+    Returns the list of names, the index of each person's mother and father
+    (-1 if blank) and each person's trait (-1 if unknown).
     """
-    data = dict()
+    names, mothers, fathers, traits = [], [], [], []
     with open(filename) as f:
-        reader = csv.DictReader(f)
+        reader = csv.reader(f)
+        header = next(reader)
+        columns = [header.index(field) for field in ("name", "mother", "father", "trait")]
         for row in reader:
-            name = row["name"]
-            data[name] = {
-                "name": name,
-                "mother": row["mother"] or None,
-                "father": row["father"] or None,
-                "trait": (True if row["trait"] == "1" else
-                          False if row["trait"] == "0" else None)
-            }
-    return data
 
+            # csv.reader returns blank lines, such as a trailing one, as empty rows
+            if not row:
+                continue
+
+            name, mother, father, trait = (row[column] for column in columns)
+            names.append(name)
+            mothers.append(mother)
+            fathers.append(father)
+            traits.append(1 if trait == "1" else 0 if trait == "0" else -1)
+
+    # Resolve parents to indices once, now that every name is known
+    index = {name: i for i, name in enumerate(names)}
+    mothers = np.array([index.get(mother, -1) for mother in mothers], dtype=np.int32)
+    fathers = np.array([index.get(father, -1) for father in fathers], dtype=np.int32)
+    trait_obs = np.array(traits, dtype=np.int8)
+
+    return names, mothers, fathers, trait_obs
 
-def powerset(s):
+
+def enumerate_assignments(mothers, fathers, trait_obs, acc):
     """
-    Return a list of all possible subsets of set s.
+    Add to each person's bins in `acc` the joint probability of every assignment
+    of gene counts and of the trait that agrees with known information.
     """
-    s = list(s)
-    return [
-        set(s) for s in itertools.chain.from_iterable(
-            itertools.combinations(s, r) for r in range(len(s) + 1)
-        )
-    ]
 
+    # With nobody in the pedigree there are no bins to add to
+    if len(trait_obs) == 0:
+        return
+
+    # Enumerate only the trait of people for whom it is unknown, one row per
+    # assignment and one column per person; everyone else's is fixed by the data
+    unknown = np.flatnonzero(trait_obs < 0)
+    traits = np.zeros((1 << len(unknown), len(trait_obs)), dtype=np.uint8)
+    traits[:, trait_obs == 1] = 1
+
+    # Bit k of the row number says whether the k-th unknown person has the trait
+    masks = np.arange(len(traits))[:, np.newaxis]
+    traits[:, unknown] = masks >> np.arange(len(unknown)) & 1
+
+    # Tabulate once the probability of each person's trait in every row of
+    # `traits` given their gene count, as it is the same for every block
+    trait_tables = get_trait_tables(traits)
+    evidence = get_evidence_tables(trait_obs)
+
+    # Walk every assignment of gene counts once, a block of rows at a time,
+    # so no more than BLOCK_SIZE joint probabilities are held at once. Blocks
+    # span a power of 3 rows, so all rows of a block share the gene counts of
+    # the first `num_prefix` people
+    num_prefix = len(trait_obs)
+    while num_prefix > 0 and 3 ** (len(trait_obs) - num_prefix + 1) * len(traits) <= BLOCK_SIZE:
+        num_prefix -= 1
+    rows = 3 ** (len(trait_obs) - num_prefix)
+
+    # Compute the most likely block first, as a lower bound on the total
+    bounds = get_prefix_bounds(mothers, fathers, evidence, num_prefix)
+    prefixes = np.argsort(bounds)[::-1]
+    partial = enumerate_block(
+        (mothers, fathers, traits, trait_tables, evidence, prefixes[0] * rows, (prefixes[0] + 1) * rows)
+    )
+    acc += partial
+    collected = partial[0, :3].sum()
+
+    # Skip the least likely blocks while their bounds add up to at most
+    # TOLERANCE of what is already collected
+    prefixes = prefixes[1:]
+    tail = np.cumsum(bounds[prefixes][::-1])
+    prefixes = prefixes[:len(prefixes) - np.searchsorted(tail, TOLERANCE * collected, side="right")]
+    blocks = (
+        (mothers, fathers, traits, trait_tables, evidence, prefix * rows, (prefix + 1) * rows)
+        for prefix in prefixes.tolist()
+    )
+
+    # Sum each person's bins over every other block
+    if len(prefixes) > 1:
+        # Blocks are independent, so spread them across every core
+        with multiprocessing.Pool() as pool:
+            for partial in pool.imap_unordered(enumerate_block, blocks):
+                acc += partial
+    else:
+        for block in blocks:
+            acc += enumerate_block(block)
 
-def joint_probability(people, one_gene, two_genes, have_trait):
+
+def get_prefix_bounds(mothers, fathers, evidence, num_prefix):
     """
-    Compute and return a joint probability.
+    Returns, for every assignment of gene counts to the first `num_prefix` people,
+    an upper bound on the total joint probability of the block of assignments
+    that start with it: the product of the known-trait probabilities of those
+    people and of the gene factors of those whose parents are also among them.
 
-    The probability returned should be the probability that
-        * everyone in set `one_gene` has one copy of the gene, and
-        * everyone in set `two_genes` has two copies of the gene, and
-        * everyone not in `one_gene` or `two_gene` does not have the gene, and
-        * everyone in set `have_trait` has the trait, and
-        * everyone not in set` have_trait` does not have the trait.
+    Every other factor of those people is at most 1, and summing the gene factors
+    (and trait probabilities) of everyone else over all their values gives 1.
     """
-    
-    joint_p = 1
+    prefixes = get_gene_assignments(num_prefix, 0, 3 ** num_prefix)
+    bounds = np.ones(len(prefixes))
+
+    parents = zip(mothers[:num_prefix].tolist(), fathers[:num_prefix].tolist())
+    for i, (mother, father) in enumerate(parents):
 
-    for person, family in people.items():
+        bounds *= evidence[i, prefixes[:, i]]
 
-        mother = family["mother"]
-        father = family ["father"]
-        
-        gene = 2 if person in two_genes else 1 if person in one_gene else 0
-        trait = True if person in have_trait else False
-        
-        trait_prob = PROBS["trait"][gene][trait]
-        gene_prob = 0
+        # A parent whose gene count is not fixed yet leaves the factor open
+        if mother >= num_prefix or father >= num_prefix:
+            continue
 
-        if mother is None and father is None:
-            gene_prob = PROBS["gene"][gene]
-            
+        if mother < 0 and father < 0:
+            bounds *= _GENE_TBL[prefixes[:, i]]
+        elif mother < 0:
+            bounds *= _CHILD_UNK_M[prefixes[:, i], prefixes[:, father]]
+        elif father < 0:
+            bounds *= _CHILD_UNK_F[prefixes[:, i], prefixes[:, mother]]
         else:
-            mother_genes = 2 if mother in two_genes else 1 if mother in one_gene else 0
-            father_genes = 2 if father in two_genes else 1 if father in one_gene else 0
-
-            if gene == 0:
-                # Get no genes from both parents
-                gene_prob_mother = get_parent_gene_probability(False, mother, mother_genes)
-                gene_prob_father = get_parent_gene_probability(False, father, father_genes)
-
-                gene_prob = gene_prob_mother * gene_prob_father
-
-            elif gene == 1:
-                # Either they get the gene from their mother 
-                # and not their father, or they get the gene 
-                # from their father and not their mother.
-                gene_prob_mother = get_parent_gene_probability(True, mother, mother_genes) * get_parent_gene_probability(False, father, father_genes)
-                gene_prob_father = get_parent_gene_probability(False, mother, mother_genes) * get_parent_gene_probability(True, father, father_genes)
-
-                # These two scenarios are mutually exclusive (only one or the other can happen), so we add:
-                gene_prob = gene_prob_mother + gene_prob_father                
-
-            elif gene == 2:
-                # Get genes from both parents
-                gene_prob_mother = get_parent_gene_probability(True, mother, mother_genes)
-                gene_prob_father = get_parent_gene_probability(True, father, father_genes)
-
-                gene_prob = gene_prob_mother * gene_prob_father            
-        
-        joint_p *= gene_prob * trait_prob
-    
-    return joint_p
-
-
-def get_parent_gene_probability(child_has_gene, parent, parent_genes):
-    """
-    Returns the probability that a child inherits or does not inherit the gene from a parent.
-    """
-    if parent is not None:
-        if child_has_gene == True:
-            if parent_genes == 0:
-                return PROBS["mutation"]
-            elif parent_genes == 1:
-                # Can pass the gene or can pass by mutation
-                return 0.5 * (1 - PROBS["mutation"]) + 0.5 * PROBS["mutation"]
-            elif parent_genes == 2:
-                return 1 - PROBS["mutation"]
+            bounds *= _CHILD[prefixes[:, i], prefixes[:, mother], prefixes[:, father]]
+
+    return bounds
+
+
+def enumerate_block(block):
+    """
+    Returns the joint probabilities of gene assignments `start` to `stop`
+    with every row of `traits`, summed into each person's bins as an array
+    with one row per person and columns for 0, 1 and 2 copies of the gene,
+    then for not having and having the trait.
+    """
+    mothers, fathers, traits, trait_tables, evidence, start, stop = block
+
+    genes = get_gene_assignments(len(mothers), start, stop)
+    acc = np.zeros((len(mothers), 5))
+
+    # Update probabilities with the joint probability of every assignment
+    joint_probability(mothers, fathers, genes, traits, trait_tables, evidence, acc)
+
+    return acc
+
+
+def get_trait_tables(traits):
+    """
+    Returns the probability of each person's trait in every row of `traits`
+    given their gene count, indexed by [person, genes, row].
+    """
+    return np.stack([_TRAIT_TBL[:, traits[:, i]] for i in range(traits.shape[1])])
+
+
+def get_evidence_tables(trait_obs):
+    """
+    Returns the probability of each person's known trait given their gene count,
+    indexed by [person, genes], or 1 for people whose trait is unknown.
+    """
+    evidence = np.ones((len(trait_obs), 3))
+    known = trait_obs >= 0
+    evidence[known] = _TRAIT_TBL[:, trait_obs[known]].T
+    return evidence
+
+
+def get_gene_assignments(num_people, start, stop):
+    """
+    Returns rows `start` to `stop` of the enumeration of every assignment of
+    0, 1 or 2 copies of the gene to `num_people` people, as the base-3 digits
+    of the row number (the first person's count varying slowest).
+    """
+    powers = 3 ** np.arange(num_people - 1, -1, -1)
+    return (np.arange(start, stop)[:, np.newaxis] // powers % 3).astype(np.uint8)
+
+
+def eliminate_variables(mothers, fathers, trait_obs, acc):
+    """
+    Add to each person's bins in `acc` their gene and trait distributions,
+    jointly with the known trait information, by variable elimination.
+    Each person's bins are scaled by a constant of their own, which
+    normalizing removes.
+
+    Every person contributes a factor over their own gene count (and their
+    parents'), plus a factor for their trait if it is known; summing the
+    product of all factors over everyone else's gene count leaves that
+    person's gene distribution. Passing messages once up and once down the
+    tree of clusters that the elimination order defines shares these sums
+    between everyone.
+    """
+
+    # Factors as (table, people it ranges over) pairs
+    factors = []
+    people = zip(mothers.tolist(), fathers.tolist(), trait_obs.tolist())
+    for i, (mother, father, trait) in enumerate(people):
+
+        if mother < 0 and father < 0:
+            factors.append((_GENE_TBL, (i,)))
+
+        elif mother < 0:
+            factors.append((_CHILD_UNK_M, (i, father)))
+        elif father < 0:
+            factors.append((_CHILD_UNK_F, (i, mother)))
         else:
-            if parent_genes == 0:
-                return 1 - PROBS["mutation"]
-            elif parent_genes == 1:
-                # Not pass the gene or not pass the gene by mutation
-                return 0.5 * (1 - PROBS["mutation"]) + 0.5 * PROBS["mutation"]
-            elif parent_genes == 2:
-                return PROBS["mutation"]
-    else:
-        return get_unknown_parent_gene_probability(child_has_gene)         
+            factors.append((_CHILD, (i, mother, father)))
+
+        if trait >= 0:
+            factors.append((_TRAIT_TBL[:, trait], (i,)))
+
+    # Summing people out in this order builds a tree of clusters: each person's
+    # cluster holds the factors mentioning them when they are summed out, and
+    # sends what is left to the cluster of the first of the others to go
+    order = get_elimination_order(factors, len(trait_obs))
+    position = {person: k for k, person in enumerate(order)}
+
+    # Hand every factor to the cluster of the first person it ranges over
+    local = [[] for _ in order]
+    for factor in factors:
+        local[min(factor[1], key=position.get)].append(factor)
+
+    # Pass messages up the tree, from each cluster to its parent
+    children = [[] for _ in order]
+    up = [None] * len(order)
+    for person in order:
+        incoming = local[person] + [up[child] for child in children[person]]
+        rest = set().union(*(factor[1] for factor in incoming))
+        rest.discard(person)
+        if rest:
+            up[person] = contract(incoming, sorted(rest))
+            children[min(rest, key=position.get)].append(person)
+
+    # Then back down: each cluster, with all its messages in, holds its person's
+    # distribution, and passes each child the product of everything else
+    down = [None] * len(order)
+    for person in reversed(order):
+        incoming = local[person] + [up[child] for child in children[person]]
+        if down[person] is not None:
+            incoming.append(down[person])
+
+        for child in children[person]:
+            others = [factor for factor in incoming if factor is not up[child]]
+            down[child] = contract(others, up[child][1])
+
+        gene_p, _ = contract(incoming, (person,))
+
+        # A known trait is certain; otherwise weigh each gene count's chance of it
+        trait = trait_obs[person]
+        acc[person, :3] += gene_p
+        if trait < 0:
+            acc[person, 3:] += gene_p @ _TRAIT_TBL
+        else:
+            acc[person, 3 + trait] += gene_p.sum()
 
 
-def get_unknown_parent_gene_probability(child_has_gene):
+def get_elimination_order(factors, num_people):
     """
-    Returns the probability that the child received genes from unknown parent
+    Returns an order in which to sum people out of `factors`, choosing at each
+    step the person sharing factors with the fewest others, so that the tables
+    built along the way stay small.
     """
-    if child_has_gene == True:
-        gene_prob = PROBS["gene"][0] * PROBS["mutation"]
-        gene_prob += PROBS["gene"][1] * (0.5 * (1 - PROBS["mutation"]) + 0.5 * PROBS["mutation"])
-        gene_prob += PROBS["gene"][2] * (1 - PROBS["mutation"])
+    neighbours = [set() for _ in range(num_people)]
+    for _, people in factors:
+        for person in people:
+            neighbours[person].update(people)
+    for person in range(num_people):
+        neighbours[person].discard(person)
 
-        return gene_prob
-    
-    else:
-        gene_prob = PROBS["gene"][0] * (1 - PROBS["mutation"])
-        gene_prob += PROBS["gene"][1] * (0.5 * (1 - PROBS["mutation"]) + 0.5 * PROBS["mutation"])
-        gene_prob += PROBS["gene"][2] * (PROBS["mutation"])
-        
-        return gene_prob  
-        
+    order = []
+    remaining = set(range(num_people))
+    while remaining:
+        person = min(remaining, key=lambda p: (len(neighbours[p]), p))
+        order.append(person)
+        remaining.remove(person)
+
+        # Summing a person out leaves one factor over all their neighbours
+        for neighbour in neighbours[person]:
+            neighbours[neighbour] |= neighbours[person]
+            neighbours[neighbour] -= {neighbour, person}
 
-def update(probabilities, one_gene, two_genes, have_trait, p):
+    return order
+
+
+def contract(factors, people):
+    """
+    Returns the product of `factors` summed over everyone but `people`,
+    as a (table, people) pair.
+    """
+    people = tuple(people)
+
+    # Label the people of these factors locally, as np.einsum takes at most 52 labels
+    label = {}
+    operands = []
+    for table, factor_people in factors:
+        operands += [table, [label.setdefault(p, len(label)) for p in factor_people]]
+
+    # The product is constant along anyone in `people` that no factor ranges over
+    for p in people:
+        if p not in label:
+            operands += [np.ones(3), [label.setdefault(p, len(label))]]
+
+    table = np.einsum(*operands, [label[p] for p in people])
+
+    # Rescale to keep long pedigrees from underflowing; only proportions matter
+    scale = table.max()
+    if scale > 0:
+        table = table / scale
+
+    return table, people
+
+
+def joint_probability(mothers, fathers, genes, traits, trait_tables, evidence, acc):
+    """
+    Compute the joint probability of every assignment at once and add it to `acc`.
+
+    `mothers` and `fathers` hold the column of each person's parents, or -1
+    if they are unknown. `genes` has one row per assignment of gene counts
+    (0, 1 or 2 copies) and `traits` one row per assignment of the trait
+    (1 if the person has it, 0 otherwise), with one column per person;
+    `trait_tables` and `evidence` are the matching tables from `get_trait_tables`
+    and `get_evidence_tables`.
+
+    The probability that
+        * everyone has the number of copies given by a row of `genes`, and
+        * everyone has or does not have the trait as given by a row of `traits`
+    is added to each person's gene bin (columns 0 to 2 of `acc`) and trait bin
+    (columns 3 and 4) for the values they take in that assignment. Assignments
+    adding up to at most TOLERANCE of the total may be skipped.
+    """
+
+    if numba is not None:
+        _joint_probability_nb(
+            mothers, fathers, genes, traits, trait_tables, evidence, acc,
+            _GENE_TBL, _CHILD, _CHILD_UNK_M, _CHILD_UNK_F, TOLERANCE
+        )
+        return
+
+    # The gene factor does not depend on the trait, so compute it once per row.
+    # Summed over every row of `traits`, a row's probability is its gene factor
+    # times the probability of the known traits; rows each below TOLERANCE / rows
+    # of the total cannot add up to more than TOLERANCE of it, so drop them
+    # before multiplying in the traits
+    gene_p = _gene_joint(mothers, fathers, genes)
+    mass = gene_p * np.prod(evidence[np.arange(len(acc)), genes], axis=1)
+    keep = mass >= TOLERANCE * mass.sum() / len(mass)
+    genes = genes[keep]
+    p = gene_p[keep][:, np.newaxis] * _trait_joint(genes, trait_tables)
+
+    # Sum the marginal of each row into the bin it selects for every person,
+    # counting over the flattened (people, 5) array
+    bins = 5 * np.arange(len(acc))
+    acc += np.bincount(
+        (bins + genes).ravel(), weights=np.repeat(p.sum(axis=1), len(acc)), minlength=acc.size
+    ).reshape(acc.shape)
+    acc += np.bincount(
+        (bins + 3 + traits).ravel(), weights=np.repeat(p.sum(axis=0), len(acc)), minlength=acc.size
+    ).reshape(acc.shape)
+
+
+def _gene_joint(mothers, fathers, genes):
+    """
+    Returns the probability that everyone has the number of copies given by each row of `genes`.
+    """
+    # Every block of a pedigree shares the same function, so build it once per process
+    key = (mothers.tobytes(), fathers.tobytes())
+    gene_joint = _specialized_joints.get(key)
+    if gene_joint is None:
+        namespace = {
+            "np": np,
+            "_GENE_TBL": _GENE_TBL,
+            "_CHILD": _CHILD,
+            "_CHILD_UNK_M": _CHILD_UNK_M,
+            "_CHILD_UNK_F": _CHILD_UNK_F
+        }
+        exec(build_specialized_joint(mothers, fathers), namespace)
+        gene_joint = _specialized_joints[key] = namespace["gene_joint"]
+
+    return gene_joint(genes)
+
+
+# Functions from build_specialized_joint, by the pedigree's parent columns
+_specialized_joints = {}
+
+
+def build_specialized_joint(mothers, fathers):
+    """
+    Returns the source of a function `gene_joint(genes)` computing `_gene_joint`
+    for this pedigree, with every person's factor written out as a single line
+    and their parents' columns inlined, so no branching is left at run time.
+    """
+    lines = [
+        "def gene_joint(genes):",
+        "    gene_p = np.ones(len(genes))"
+    ]
+
+    for i, (mother, father) in enumerate(zip(mothers.tolist(), fathers.tolist())):
+        if mother < 0 and father < 0:
+            lines.append(f"    gene_p *= _GENE_TBL[genes[:, {i}]]")
+        elif mother < 0:
+            lines.append(f"    gene_p *= _CHILD_UNK_M[genes[:, {i}], genes[:, {father}]]")
+        elif father < 0:
+            lines.append(f"    gene_p *= _CHILD_UNK_F[genes[:, {i}], genes[:, {mother}]]")
+        else:
+            lines.append(f"    gene_p *= _CHILD[genes[:, {i}], genes[:, {mother}], genes[:, {father}]]")
+
+    lines.append("    return gene_p")
+    return "\n".join(lines) + "\n"
+
+
+def _trait_joint(genes, trait_tables):
     """
-    Add to `probabilities` a new joint probability `p`.
-    Each person should have their "gene" and "trait" distributions updated.
-    Which value for each distribution is updated depends on whether
-    the person is in `have_gene` and `have_trait`, respectively.
+    Returns the probability of every row of traits given each row of `genes`,
+    indexed by [gene row, trait row].
     """
-    
-    for person in probabilities:
-        gene = 2 if person in two_genes else 1 if person in one_gene else 0
-        trait = True if person in have_trait else False
+    trait_p = np.ones((len(genes), trait_tables.shape[2]))
+
+    for i in range(genes.shape[1]):
+        trait_p *= trait_tables[i][genes[:, i]]
+
+    return trait_p
 
-        probabilities[person]["gene"][gene] += p
-        probabilities[person]["trait"][trait] += p
-    
 
-def normalize(probabilities):
+def _joint_probability_loop(
+    mothers, fathers, genes, traits, trait_tables, evidence, acc,
+    gene_tbl, child, child_unk_m, child_unk_f, tolerance
+):
     """
-    Update `probabilities` such that each probability distribution
-    is normalized (i.e., sums to 1, with relative proportions the same).
+    Same as `joint_probability`, written as plain loops over arrays for Numba to compile.
     """
+    trait_sums = np.zeros(traits.shape[0])
+
+    # Probability added so far, and an upper bound on what was skipped
+    collected = 0.0
+    skipped = 0.0
+
+    for g in range(genes.shape[0]):
+
+        gene_p = 1.0
+        evidence_p = 1.0
+        skip = False
+        for i in range(genes.shape[1]):
+            gene = genes[g, i]
+
+            if mothers[i] < 0 and fathers[i] < 0:
+                gene_p *= gene_tbl[gene]
+            elif mothers[i] < 0:
+                gene_p *= child_unk_m[gene, genes[g, fathers[i]]]
+            elif fathers[i] < 0:
+                gene_p *= child_unk_f[gene, genes[g, mothers[i]]]
+            else:
+                gene_p *= child[gene, genes[g, mothers[i]], genes[g, fathers[i]]]
+
+            # Every factor still to come is at most 1, and the unknown traits sum
+            # to 1, so this bounds the row's total over every row of `traits`
+            evidence_p *= evidence[i, gene]
+            mass = gene_p * evidence_p
+            if skipped + mass <= tolerance * collected:
+                skipped += mass
+                skip = True
+                break
+
+        if skip:
+            continue
+
+        gene_sum = 0.0
+        for t in range(traits.shape[0]):
+            trait_p = 1.0
+            for i in range(genes.shape[1]):
+                trait_p *= trait_tables[i, genes[g, i], t]
+            gene_sum += gene_p * trait_p
+            trait_sums[t] += gene_p * trait_p
+        collected += gene_sum
+
+        for i in range(genes.shape[1]):
+            acc[i, genes[g, i]] += gene_sum
+
+    for t in range(traits.shape[0]):
+        for i in range(traits.shape[1]):
+            acc[i, 3 + traits[t, i]] += trait_sums[t]
+
+
+if numba is not None:
+    _joint_probability_nb = numba.njit(cache=True, fastmath=True)(_joint_probability_loop)
+
+
+def get_child_gene_table(mother_pass, father_pass):
+    """
+    Returns a table of the probability that a child has 0, 1 or 2 copies of the gene,
+    indexed by [child_genes, mother_genes, father_genes], given the probability that
+    each parent does not pass or passes the gene, indexed by [passes, parent_genes].
+    """
+    mother_p = mother_pass[:, :, np.newaxis]
+    father_p = father_pass[:, np.newaxis, :]
+
+    return np.stack([
+        # Get no genes from both parents
+        mother_p[0] * father_p[0],
 
-    for person, features in probabilities.items():        
-        for feature, distribution in features.items():
-            s = sum(distribution.values())
-            for key, value in distribution.items():
-                probabilities[person][feature][key] = value / s 
+        # Either they get the gene from their mother and not their father,
+        # or from their father and not their mother (mutually exclusive, so we add)
+        mother_p[1] * father_p[0] + mother_p[0] * father_p[1],
+
+        # Get genes from both parents
+        mother_p[1] * father_p[1]
+    ])
+
+
+def get_unknown_parent_gene_probability(child_has_gene):
+    """
+    Returns the probability that the child received genes from unknown parent
+    """
+    return sum(_GENE_TBL[genes] * _PASS[child_has_gene][genes] for genes in range(3))
+
+
+# Probability that the child received or did not receive the gene from an unknown parent,
+# indexed by whether they received it
+_UNKNOWN = (get_unknown_parent_gene_probability(0), get_unknown_parent_gene_probability(1))
+
+# Probability that a child has 0, 1 or 2 copies of the gene, indexed by
+# [child_genes, mother_genes, father_genes], or without the axis of an unknown parent
+_CHILD = get_child_gene_table(np.array(_PASS), np.array(_PASS))
+_CHILD_UNK_M = get_child_gene_table(np.array(_UNKNOWN)[:, np.newaxis], np.array(_PASS))[:, 0, :]
+_CHILD_UNK_F = get_child_gene_table(np.array(_PASS), np.array(_UNKNOWN)[:, np.newaxis])[:, :, 0]
+
+
+def normalize(acc):
+    """
+    Update `acc` such that each person's gene and trait distributions
+    are normalized (i.e., sum to 1, with relative proportions the same).
+    """
+    acc[:, :3] /= acc[:, :3].sum(axis=1, keepdims=True)
+    acc[:, 3:] /= acc[:, 3:].sum(axis=1, keepdims=True)
 
 
 if __name__ == "__main__":